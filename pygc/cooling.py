@@ -9,10 +9,18 @@ from pyathena.classic.cooling import coolftn
 import numpy as np
 from astropy import constants as ac
 from astropy import units as au
-from scipy.optimize import bisect
-from scipy.interpolate import interp1d
 
 muH = 1.4271
+# unit conversion constants used in the LP threshold density:
+# rho[Msun pc-3] = _KLP*cs2[km2 s-2]/dx[pc]^2, nH[cm-3] = _KnH*rho[Msun pc-3]
+# and cs2[km2 s-2] = _Kcs2*T[K]/mu
+_KLP = 8.86/np.pi/ac.G.to('pc km**2 s**-2 Msun**-1').value
+_KnH = (au.Msun/au.pc**3/muH/ac.m_p).to('cm**-3').value
+_Kcs2 = (ac.k_B*au.K/ac.m_p).to('km**2 s**-2').value
+# dust optical depth per unit kappa_d[pc2 Msun-1]*dx[pc]*nH[cm-3]
+_Ktau = (au.pc**2/au.Msun*au.pc*muH*ac.m_p/au.cm**3).cgs.value
+# primary cosmic ray heating rate per particle [erg s-1]
+_Gcr = (10*au.eV*2e-16/au.s).to('erg s-1').value
 
 class Cooling(coolftn):
     def __init__(self, hr=None, dx=None, surf=None, efftau=None):
@@ -21,19 +29,25 @@ class Cooling(coolftn):
         self._kappa_d = 0.2 # pc2 Msun-1
         self.surf0 = 10.7
         self.surf = surf
-        self._coolft=interp1d(self.temp, self.cool)
-        self._heatft=interp1d(self.temp, self.heat)
-        self._muft=interp1d(self.temp, self.temp/self.T1)
+        idx = np.argsort(self.temp)
+        self._T = np.asarray(self.temp)[idx]
+        self._cool = np.asarray(self.cool)[idx]
+        self._heat = np.asarray(self.heat)[idx]
+        self._mu = np.asarray(self.temp/self.T1)[idx]
+        self._coolft = lambda T: np.interp(T, self._T, self._cool)
+        self._heatft = lambda T: np.interp(T, self._T, self._heat)
+        self._muft = lambda T: np.interp(T, self._T, self._mu)
         self.heat_ratio = hr
         self.efftau = efftau
         self.dx = dx
+        # temperature grid on which the net heating rate is tabulated
+        self._Tgrid = np.geomspace(12.95, 1e7, 4096)
     def fuv(self, T):
         """return tabulated FUV heating rate"""
         return self.heat_ratio*self._heatft(T)
     def fuv_le(self, nH, T):
         """return FUV heating rate at density n_H with the local extinction"""
-        taucell = (self._kappa_d*au.pc**2/au.Msun*self.dx*au.pc\
-                *muH*ac.m_p*nH/au.cm**3).cgs.value
+        taucell = _Ktau*self._kappa_d*self.dx*nH
         return self.fuv(T)*np.exp(-self.efftau*taucell)
     def cr(self, T):
         """
@@ -43,31 +57,57 @@ class Cooling(coolftn):
         muion = 0.6182
         muato = 1.295
         if self.surf > self.surf0:
-            
-            heat = self.heat_ratio*(10*au.eV*2e-16/au.s).to('erg s-1').value*self.surf0/self.surf
+            heat = self.heat_ratio*_Gcr*self.surf0/self.surf
         else:
-            heat = self.heat_ratio*(10*au.eV*2e-16/au.s).to('erg s-1').value
+            heat = self.heat_ratio*_Gcr
             # note that heat_ratio = SFR/SFR_sn, such that heat_ratio*2e-16 = primary CR rate.
         return (self._muft(T) - muion)/(muato-muion)*heat
     def get_prs(self, nH, T):
         """Calculate pressure from density and temperature"""
         prs = nH*muH/self._muft(T)*T
         return prs
-    def get_Teq(self, nH, fuvle=False, cr=False, turb=0):
-        """Calculate equilibrium temperature at the density n_H"""
+    def _netheat(self, nH, T, fuvle=False, cr=False, turb=0):
+        """return net volumetric heating rate; nH and T are broadcast"""
         if fuvle:
             if cr:
-                heat = lambda x: nH*(self.fuv_le(nH,x)+self.cr(x)+turb*2e-26)
+                heat = nH*(self.fuv_le(nH,T)+self.cr(T)+turb*2e-26)
             else:
-                heat = lambda x: nH*(self.fuv_le(nH,x)+turb*2e-26)
+                heat = nH*(self.fuv_le(nH,T)+turb*2e-26)
         else:
-            heat = lambda x: nH*self.fuv(x)+turb*2e-26
-        cool = lambda x: nH**2*self._coolft(x)
-        try:
-            Teq = bisect(lambda x: heat(x)-cool(x), 12.95, 1e7)
-        except ValueError:
-            Teq = np.nan
-        return Teq
+            heat = nH*self.fuv(T)+turb*2e-26
+        cool = nH**2*self._coolft(T)
+        return heat - cool
+    def get_Teq(self, nH, fuvle=False, cr=False, turb=0):
+        """
+        Calculate equilibrium temperature at the density n_H
+
+        nH may be a scalar or an array. The net heating rate is evaluated on
+        a fixed temperature grid for all densities at once to bracket the
+        lowest root, which is then refined by bisecting the bit pattern of
+        the float64 temperature (at most 64 steps, to machine precision).
+        Returns nan where the root is not bracketed in [12.95, 1e7] K.
+        """
+        T = self._Tgrid
+        nH_ = np.atleast_1d(np.asarray(nH, dtype=float))
+        F = self._netheat(nH_[:,None], T, fuvle=fuvle, cr=cr, turb=turb)
+        cross = np.diff(np.sign(F), axis=1) != 0
+        ok = cross.any(axis=1) & (F[:,0]*F[:,-1] <= 0)
+        idx = np.argmax(cross, axis=1)[ok]
+        nHb = nH_[ok]
+        sgn = np.sign(F[ok,idx])
+        # positive floats are ordered as their int64 bit patterns
+        lo = T[idx].view(np.int64)
+        hi = T[idx+1].view(np.int64)
+        while np.any(hi - lo > 1):
+            mid = lo + (hi - lo)//2
+            Fm = self._netheat(nHb, mid.view(np.float64), fuvle=fuvle, cr=cr,
+                    turb=turb)
+            left = np.sign(Fm) == sgn
+            lo = np.where(left, mid, lo)
+            hi = np.where(left, hi, mid)
+        Teq = np.full(len(nH_), np.nan)
+        Teq[ok] = lo.view(np.float64)
+        return Teq.reshape(np.shape(nH))[()]
     def get_Peq(self, nH, fuvle=False, cr=False, turb=0):
         """Calculate equilibrium pressure at the density n_H"""
         Teq = self.get_Teq(nH, fuvle=fuvle, cr=cr, turb=turb)
@@ -76,47 +116,35 @@ class Cooling(coolftn):
     def get_rhoLP(self, dx, cs2, asnH=True):
         """Calculate LP threshold density"""
         if isinstance(dx, au.quantity.Quantity):
-            dx = dx.to('pc')
-        else:
-            dx = dx * au.pc
+            dx = dx.to('pc').value
         if isinstance(cs2, au.quantity.Quantity):
-            cs2 = cs2.to('km**2 s**-2')
-        else:
-            cs2 = cs2 * (au.km/au.s)**2
-        rhoLP = 8.86/np.pi*cs2/ac.G/dx**2
+            cs2 = cs2.to('km**2 s**-2').value
+        rhoLP = _KLP*cs2/dx**2
         if asnH:
-            rhoLP = (rhoLP/muH/ac.m_p).to('cm**-3').value
-        else:
-            rhoLP = rhoLP.to('Msun pc**-3').value
+            rhoLP = rhoLP*_KnH
         return rhoLP
     def get_rhoLP_from_T(self, dx, T, asnH=True):
         """
         Caculate LP threshold density from given temperature
         """
-        if isinstance(dx, au.quantity.Quantity):
-            dx = dx.to('pc')
-        else:
-            dx = dx * au.pc
         if isinstance(T, au.quantity.Quantity):
-            T = T.to('K')
-        else:
-            T = T * au.K
-        cs2=ac.k_B*T/self._muft(T)/ac.m_p
+            T = T.to('K').value
+        cs2 = _Kcs2*T/self._muft(T)
         return self.get_rhoLP(dx, cs2, asnH=asnH)
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
-    lp = LPthres()
+    lp = Cooling()
 
     heat_ratios = [1e0,1e1,1e2,1e3]
     dxs = [8*au.pc, 4*au.pc, 2*au.pc]
     N=1000
     nH = np.logspace(-1,5,N)
 
-    Teqs = [[],[],[],[]]
-    for Teq, heat_ratio in zip(Teqs, heat_ratios):
-        for _nH in nH:
-            Teq.append(lp.get_Teq(heat_ratio, _nH))
+    Teqs = []
+    for heat_ratio in heat_ratios:
+        lp.heat_ratio = heat_ratio
+        Teqs.append(lp.get_Teq(nH))
     Teq = np.array(Teqs)
     Peq = lp.get_prs(nH, Teq)
 
@@ -148,7 +176,7 @@ if __name__ == '__main__':
     # plot density threshold on n-T plane
     T = np.logspace(np.log10(12.95), 5)
     for dx in dxs:
-        nth = lp.get_rhoLPeq(dx, T)
+        nth = lp.get_rhoLP_from_T(dx, T)
         plt.loglog(nth, T, 'k--')
 
     plt.xlim(1e-1,1e5)
@@ -57,7 +57,7 @@ if __name__ == '__main__':
     # load simulation
     s = pa.LoadSim(args.indir)
     dat_tavg = pickle.load(open(args.indir+'/postproc_tavg/tavg.pkl','rb'))
-    add_derived_fields(dat_tavg, 'surf')
+    add_derived_fields(dat_tavg, 'surf', in_place=True)
     surf_th, mask = mask_ring_by_mass(dat_tavg, mf_crit=args.mf_crit, Rmax=args.Rmax)
 
     for num in mynums:
@@ -22,6 +22,10 @@ if __name__ == '__main__':
     parser.add_argument('--outdir', default=None, help='output directory (default=indir/postproc_tavg')
     parser.add_argument('--mpi', action='store_true', help='enable mpi')
     parser.add_argument('--twophase', action='store_true')
+    parser.add_argument('--nthreads', default=1, type=int,
+                        help='number of snapshots processed concurrently')
+    parser.add_argument('--zchunk', default=None, type=int,
+                        help='stream derived fields over z-chunks of this size (requires dask)')
     args = parser.parse_args()
 
     if args.mpi:
@@ -61,7 +65,9 @@ if __name__ == '__main__':
 
     # load simulation
     s = pa.LoadSim(args.indir)
-    dat = sum_dataset(s, mynums, twophase=args.twophase)
+    chunks = None if args.zchunk is None else {'z':args.zchunk}
+    dat = sum_dataset(s, mynums, twophase=args.twophase, chunks=chunks,
+                      nthreads=args.nthreads)
 
     if args.mpi:
         # dump local sum
@@ -58,10 +58,10 @@ if __name__ == '__main__':
         t = ds.domain['time']
         dat = ds.get_field(['density','velocity','pressure'])
         dat = dat.drop(['velocity1','velocity2'])
-        add_derived_fields(dat, 'T')
+        add_derived_fields(dat, 'T', in_place=True)
         # select two-phase gas
         dat = dat.where(dat.T < Twarm)
-        add_derived_fields(dat, ['sz','cs','H'])
+        add_derived_fields(dat, ['sz','cs','H'], in_place=True)
 
         np.savetxt("{}/{}.{:04d}.txt".format(outdir,fname,num),
             [t, dat.sz, dat.cs, dat.H])
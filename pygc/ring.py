@@ -1,5 +1,5 @@
-from .util import add_derived_fields, grid_msp
-from .pot import MHubble, Plummer
+from .util import add_derived_fields, grid_msp, gz_from_potential,\
+        above_midplane, midplane, gz_ext
 from pyathena.io.read_vtk import read_vtk
 from scipy.optimize import bisect
 import numpy as np
@@ -14,7 +14,7 @@ def mask_ring_by_mass(dat, mf_crit=0.9, Rmax=None):
 
     if Rmax:
         if not 'R' in dat.data_vars:
-            add_derived_fields(dat, fields='R')
+            add_derived_fields(dat, fields='R', in_place=True)
         R_mask = dat.R < Rmax
 
     if mf_crit:
@@ -29,8 +29,6 @@ def mask_ring_by_mass(dat, mf_crit=0.9, Rmax=None):
 
 def ring_avg(s, num, mask, sfr_dt=10):
     dz = s.domain['dx'][2]
-    bul = MHubble(s.par['problem']['R_b'], s.par['problem']['rho_b'])
-    BH = Plummer(s.par['problem']['M_c'], s.par['problem']['R_c'])
 
     ds = s.load_vtk(num)
     sp = s.load_starpar_vtk(num)
@@ -43,38 +41,35 @@ def ring_avg(s, num, mask, sfr_dt=10):
     dat = ds.get_field(['density','velocity','pressure',
         'gravitational_potential'], as_xarray=True)
     dat = dat.drop(['velocity1','velocity2'])
-    add_derived_fields(dat, 'gz_sg')
+    add_derived_fields(dat, 'gz_sg', in_place=True)
     dat = dat.drop('gravitational_potential')
 
     # seperate individual contributions to the gravitational field.
     ds = read_vtk('{}/postproc_gravity/gc.{:04d}.Phi.vtk'.format(s.basedir, num))
     Phigas = ds.get_field('Phi').Phi
-    phir = Phigas.shift(z=-1)
-    phil = Phigas.shift(z=1)
-    phir.loc[{'z':phir.z[-1]}] = 3*phir.isel(z=-2) - 3*phir.isel(z=-3) + phir.isel(z=-4)
-    phil.loc[{'z':phir.z[0]}] = 3*phil.isel(z=1) - 3*phil.isel(z=2) + phil.isel(z=3)
-    gz_gas = (phil-phir)/(2*dz)
+    gz_gas = gz_from_potential(Phigas, dz)
     dat['gz_starpar'] = dat.gz_sg - gz_gas # order is important!
     dat['gz_gas'] = gz_gas # order is important!
-    dat['gz_ext'] = bul.gz(dat.x, dat.y, dat.z).T + BH.gz(dat.x, dat.y, dat.z).T
+    dat['gz_ext'] = gz_ext(s, dat)
 
     # add derived fields
     
-    dat['Wgas'] = 0.5*(dat.density*abs(dat.gz_gas)*dz).sum(dim='z')
-    dat['Wsp'] = 0.5*(dat.density*abs(dat.gz_starpar)*dz).sum(dim='z')
-    dat['Wext'] = 0.5*(dat.density*abs(dat.gz_ext)*dz).sum(dim='z')
+    dat['Wgas'] = 0.5*(dat.density*abs(dat.gz_gas)).sum(dim='z')*dz
+    dat['Wsp'] = 0.5*(dat.density*abs(dat.gz_starpar)).sum(dim='z')*dz
+    dat['Wext'] = 0.5*(dat.density*abs(dat.gz_ext)).sum(dim='z')*dz
 
-    dat['Wgas_oneside'] = -(dat.density*dat.gz_gas    *dz).where(dat.z>0).sum(dim='z')
-    dat['Wsp_oneside']  = -(dat.density*dat.gz_starpar*dz).where(dat.z>0).sum(dim='z')
-    dat['Wext_oneside'] = -(dat.density*dat.gz_ext    *dz).where(dat.z>0).sum(dim='z')
+    up = above_midplane(dat)
+    dat['Wgas_oneside'] = -(up.density*up.gz_gas    ).sum(dim='z')*dz
+    dat['Wsp_oneside']  = -(up.density*up.gz_starpar).sum(dim='z')*dz
+    dat['Wext_oneside'] = -(up.density*up.gz_ext    ).sum(dim='z')*dz
 
     dat = dat.drop(['gz_sg', 'gz_starpar', 'gz_gas', 'gz_ext'])
-    add_derived_fields(dat, ['surf','Pturb'])
+    add_derived_fields(dat, ['surf','Pturb'], in_place=True)
     dat = dat.drop('velocity3')
 
-    dat['n0'] = dat.density.interp(z=0)
-    dat['Pth_mid'] = dat.pressure.interp(z=0)
-    dat['Pturb_mid'] = dat.Pturb.interp(z=0)
+    dat['n0'] = midplane(dat.density)
+    dat['Pth_mid'] = midplane(dat.pressure)
+    dat['Pturb_mid'] = midplane(dat.Pturb)
     dat['Pth_top'] = 0.5*(dat.pressure.isel(z=-1)+dat.pressure.isel(z=0))
     dat['Pturb_top'] = 0.5*(dat.Pturb.isel(z=-1)+dat.Pturb.isel(z=0))
 
@@ -2,10 +2,14 @@ import pyathena as pa
 from pathlib import Path
 from pyathena.util.units import Units
 from pyathena.classic.cooling import coolftn
+from .pot import MHubble, Plummer
 import numpy as np
 import pandas as pd
 import xarray as xr
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 Twarm = 2.0e4
 u = Units()
@@ -50,65 +54,176 @@ def bracket_snapshot_number(s, t0, id0=True):
             a = c
     return (a, b)
 
-def add_derived_fields(dat, fields=[]):
-    """Add derived fields in a Dataset
+@lru_cache(maxsize=1)
+def _get_coolftn():
+    """Return coolftn instance, building its tables only once"""
+    return coolftn()
 
-    Parameters
-    ----------
-    dat    : xarray Dataset of variables
-    fields : list containing derived fields to be added.
-               ex) ['H', 'surf', 'T']
-    """
+def midplane(arr):
+    """Return arr linearly interpolated to z = 0
 
-    try:
-        dx = (dat.x[1]-dat.x[0]).values[()]
-        dy = (dat.y[1]-dat.y[0]).values[()]
-        dz = (dat.z[1]-dat.z[0]).values[()]
-    except IndexError:
-        pass
+    Equivalent to arr.interp(z=0), but reads only the two z slices
+    adjacent to the midplane.
+    """
+    z = arr.z.values
+    iz = int(np.searchsorted(z, 0.0)) - 1
+    w = (0.0 - z[iz])/(z[iz+1] - z[iz])
+    lo = arr.isel(z=iz).drop_vars('z')
+    hi = arr.isel(z=iz+1).drop_vars('z')
+    return ((1-w)*lo + w*hi).assign_coords(z=0.0)
 
-    d = dat.copy()
+def above_midplane(dat):
+    """Return the z > 0 part of dat as a slice, without masking"""
+    iz0 = int(np.searchsorted(dat.z.values, 0.0, side='right'))
+    return dat.isel(z=slice(iz0, None))
 
-    if 'sz' in fields:
-        sz2 = (dat.density*dat.velocity3**2).interp(z=0).sum()/dat.density.interp(z=0).sum()
-        d['sz'] = np.sqrt(sz2)
+def wmean(arr, weights, dim=None):
+    """Return weighted mean of arr, ignoring NaNs in arr or weights
 
-    if 'cs' in fields:
-        cs2 = dat.pressure.interp(z=0).sum()/dat.density.interp(z=0).sum()
-        d['cs'] = np.sqrt(cs2)
+    Numerator and denominator are each computed by a single dot product,
+    without materializing arr*weights or the NaN-masked weights.
 
-    if 'H' in fields:
-        H2 = (dat.density*dat.z**2).sum()/dat.density.sum()
-        d['H'] = np.sqrt(H2)
+    Parameters
+    ----------
+    arr     : xr.DataArray to be averaged
+    weights : xr.DataArray of weights, broadcastable against arr
+    dim     : dimension(s) over which to average. Default is all.
+    """
+    return arr.weighted(weights.fillna(0)).mean(dim=dim)
 
-    if 'surf' in fields:
-        d['surf'] = (dat.density*dz).sum(dim='z')
+def gz_from_potential(phi, dz):
+    """Return vertical gravity -dphi/dz by central difference
 
-    if 'R' in fields:
-        d.coords['R'] = np.sqrt(dat.y**2 + dat.x**2)
+    The potential is extrapolated quadratically beyond the vertical
+    boundaries, so that the output has the same shape as the input.
 
-    if 'phi' in fields:
-        d.coords['phi'] = np.arctan2(dat.y, dat.x)
+    Parameters
+    ----------
+    phi : xr.DataArray of gravitational potential with dimension 'z'
+    dz  : grid spacing in z
+    """
+    axis = phi.get_axis_num('z')
+    p = np.moveaxis(phi.values, axis, 0)
+    gz = np.empty_like(p)
+    gz[1:-1] = p[:-2] - p[2:]
+    gz[0] = 3*p[0] - 4*p[1] + p[2]
+    gz[-1] = 4*p[-2] - 3*p[-1] - p[-3]
+    gz /= 2*dz
+    return xr.DataArray(np.moveaxis(gz, 0, axis), coords=phi.coords,
+            dims=phi.dims)
+
+def _derive_sz(dat, dz):
+    sz2 = midplane(dat.Pturb).sum()/midplane(dat.density).sum()
+    dat['sz'] = np.sqrt(sz2)
+
+def _derive_cs(dat, dz):
+    cs2 = midplane(dat.pressure).sum()/midplane(dat.density).sum()
+    dat['cs'] = np.sqrt(cs2)
+
+def _derive_H(dat, dz):
+    # reduce density to a vertical profile first, in a single pass
+    rho_z = dat.density.sum(dim=[d for d in dat.density.dims if d != 'z'])
+    H2 = wmean(dat.z**2, rho_z)
+    dat['H'] = np.sqrt(H2)
+
+def _derive_surf(dat, dz):
+    dat['surf'] = dat.density.sum(dim='z')*dz
+
+def _derive_R(dat, dz):
+    dat.coords['R'] = np.sqrt(dat.y**2 + dat.x**2)
+
+def _derive_phi(dat, dz):
+    dat.coords['phi'] = np.arctan2(dat.y, dat.x)
+
+def _derive_Pturb(dat, dz):
+    dat['Pturb'] = dat.density*dat.velocity3**2
+
+def _derive_T(dat, dz):
+    cf = _get_coolftn()
+    T1 = (u.pok/u.muH)*dat.pressure/dat.density # muH = Dcode/mH
+    # table lookup is applied blockwise, in parallel for dask arrays
+    dat['T'] = xr.apply_ufunc(cf.get_temp, T1, dask='parallelized',
+            output_dtypes=[np.float64])
+
+def _derive_gz_sg(dat, dz):
+    dat['gz_sg'] = gz_from_potential(dat.gravitational_potential, dz)
+
+def _derive_Pgrav(dat, dz):
+    # weight of the gas above the midplane
+    up = above_midplane(dat)
+    dat['Pgrav'] = -(up.density*(up.gz_sg+up.gz_ext)).sum(dim='z')*dz
+
+# functions computing each derived field and the fields they require.
+# gz_ext is not derivable and must be provided, e.g., by gz_ext(s, dat).
+_DERIVED = {'sz':_derive_sz, 'cs':_derive_cs, 'H':_derive_H,
+            'surf':_derive_surf, 'R':_derive_R, 'phi':_derive_phi,
+            'Pturb':_derive_Pturb, 'T':_derive_T, 'gz_sg':_derive_gz_sg,
+            'Pgrav':_derive_Pgrav}
+_DEPS = {'sz':['Pturb'], 'Pgrav':['gz_sg','gz_ext']}
+
+def _resolve_fields(dat, fields):
+    """Return fields to be computed, ordered such that dependencies come first
+
+    Dependencies already present in dat are not recomputed.
+    """
+    order = []
+    def visit(f, required):
+        if f in order or (required and f in dat.variables):
+            return
+        if f not in _DERIVED:
+            raise ValueError("cannot derive field {}".format(f))
+        for dep in _DEPS.get(f, []):
+            visit(dep, True)
+        order.append(f)
+    for f in fields:
+        visit(f, False)
+    return order
+
+def add_derived_fields(dat, fields=[], in_place=False):
+    """Add derived fields in a Dataset
 
-    if 'Pturb' in fields:
-        d['Pturb'] = dat.density*dat.velocity3**2
+    Parameters
+    ----------
+    dat      : xarray Dataset of variables
+    fields   : list containing derived fields to be added.
+                 ex) ['H', 'surf', 'T']
+    in_place : if True, add fields to dat itself. Otherwise, add them to a
+               shallow copy of dat, which shares the data arrays of dat.
+    """
+    if isinstance(fields, str):
+        fields = [fields]
 
-    if 'T' in fields:
-        cf = coolftn()
-        pok = dat.pressure*u.pok
-        T1 = pok/(dat.density*u.muH) # muH = Dcode/mH
-        d['T'] = xr.DataArray(cf.get_temp(T1.values), coords=T1.coords,
-                dims=T1.dims)
+    try:
+        dz = (dat.z[1]-dat.z[0]).values[()]
+    except IndexError:
+        dz = None
 
-    if 'gz_sg' in fields:
-        phir = dat.gravitational_potential.shift(z=-1)
-        phil = dat.gravitational_potential.shift(z=1)
-        phir.loc[{'z':phir.z[-1]}] = 3*phir.isel(z=-2) - 3*phir.isel(z=-3) + phir.isel(z=-4)
-        phil.loc[{'z':phir.z[0]}] = 3*phil.isel(z=1) - 3*phil.isel(z=2) + phil.isel(z=3)
-        d['gz_sg'] = (phil-phir)/(2*dz)
+    d = dat if in_place else dat.copy(deep=False)
+    for f in _resolve_fields(d, fields):
+        _DERIVED[f](d, dz)
 
     return d
 
+_gz_ext_cache = {}
+
+def gz_ext(s, dat):
+    """Return vertical gravity of the external (bulge + BH) potential
+
+    The field depends only on the potential parameters and the grid, so
+    the result for the last grid is cached and reused for later snapshots.
+    """
+    par = s.par['problem']
+    key = (par['R_b'], par['rho_b'], par['M_c'], par['R_c'])\
+        + tuple((c.size, c[0], c[-1]) for c in (dat.x.values, dat.y.values,
+                                                dat.z.values))
+    if key not in _gz_ext_cache:
+        bul = MHubble(par['R_b'], par['rho_b'])
+        BH = Plummer(par['M_c'], par['R_c'])
+        _gz_ext_cache.clear()
+        _gz_ext_cache[key] = bul.gz(dat.x, dat.y, dat.z).T\
+                + BH.gz(dat.x, dat.y, dat.z).T
+    return _gz_ext_cache[key]
+
 def count_SNe(s, ts, te, ncrit):
     """Count the number of SNe and map the result onto a grid
 
@@ -128,8 +243,6 @@ def count_SNe(s, ts, te, ncrit):
     re1, re2 = s.domain['re'][0], s.domain['re'][1]
     dx1, dx2 = s.domain['dx'][0], s.domain['dx'][1]
     Nx1, Nx2 = s.domain['Nx'][0], s.domain['Nx'][1]
-    i = np.arange(Nx1)
-    j = np.arange(Nx2)
     x = np.linspace(le1+0.5*dx1, re1-0.5*dx1, Nx1)
     y = np.linspace(le2+0.5*dx2, re2-0.5*dx2, Nx2)
     # load supernova dump
@@ -137,13 +250,11 @@ def count_SNe(s, ts, te, ncrit):
     # filter SNs satisfying (ts < t < te) and (n > n_crit)
     sn = sn[(sn.time > ts)&(sn.time < te)&(sn.navg > ncrit)]
     # remap the number of SNs onto a grid
-    sn['i'] = np.floor((sn.x1sn-le1)/dx1).astype('int32')
-    sn['j'] = np.floor((sn.x2sn-le2)/dx2).astype('int32')
-    sn = sn.groupby(['j','i']).size()
-    idx = pd.MultiIndex.from_product([j,i], names=['j','i'])
-    NSNe = pd.Series(np.nan*np.zeros(Nx1*Nx2), index=idx)
-    NSNe[sn.index] = sn
-    NSNe = NSNe.unstack().values
+    i = np.floor((sn.x1sn.values-le1)/dx1).astype(np.int64)
+    j = np.floor((sn.x2sn.values-le2)/dx2).astype(np.int64)
+    NSNe = np.bincount(j*Nx1 + i, minlength=Nx1*Nx2).reshape(Nx2, Nx1)
+    NSNe = NSNe.astype(float)
+    NSNe[NSNe==0] = np.nan
     NSNe = xr.DataArray(NSNe, dims=['y','x'], coords=[y, x])
     return NSNe
 
@@ -154,8 +265,6 @@ def grid_msp(s, num, agemin, agemax):
     re1, re2 = s.domain['re'][0], s.domain['re'][1]
     dx1, dx2 = s.domain['dx'][0], s.domain['dx'][1]
     Nx1, Nx2 = s.domain['Nx'][0], s.domain['Nx'][1]
-    i = np.arange(Nx1)
-    j = np.arange(Nx2)
     x = np.linspace(le1+0.5*dx1, re1-0.5*dx1, Nx1)
     y = np.linspace(le2+0.5*dx2, re2-0.5*dx2, Nx2)
     # load starpar vtk
@@ -164,40 +273,38 @@ def grid_msp(s, num, agemin, agemax):
     sp = sp[(sp['mage'] < agemax)&
             (sp['mage'] > agemin)]
     # remap the starpar onto a grid
-    sp['i'] = np.floor((sp.x1-le1)/dx1).astype('int32')
-    sp['j'] = np.floor((sp.x2-le2)/dx2).astype('int32')
-    sp = sp.groupby(['j','i']).sum()
-    idx = pd.MultiIndex.from_product([j,i], names=['j','i'])
-    msp = pd.Series(np.zeros(Nx1*Nx2), index=idx)
-    msp[sp.index] = sp.mass
-    msp = msp.unstack().values
+    i = np.floor((sp.x1.values-le1)/dx1).astype(np.int64)
+    j = np.floor((sp.x2.values-le2)/dx2).astype(np.int64)
+    msp = np.bincount(j*Nx1 + i, weights=sp.mass.values,
+            minlength=Nx1*Nx2).reshape(Nx2, Nx1)
     msp = xr.DataArray(msp, dims=['y','x'], coords=[y,x])
     return msp
 
-def sum_dataset(s, nums, twophase=False):
-    """Do time-summation on Datasets and return the summed Dataset.
-
-    Parameters
-    ----------
-    s : LoadSimTIGRESSGC instance to be analyzed.
-    nums :list of snapshot numbers to add
-    twophase : include two-phase gas only
-    """
+# LoadSim keeps the last loaded snapshot as its state; serialize the loaders
+_load_lock = threading.Lock()
 
+def _load_and_derive(s, num, twophase=False, chunks=None):
+    """Load a snapshot and add the derived fields summed in sum_dataset"""
     fields = ['density','velocity','pressure','gravitational_potential']
 
-    # load a first vtk
-    ds = s.load_vtk(num=nums[0])
+    with _load_lock:
+        ds = s.load_vtk(num=num)
     dat = ds.get_field(fields, as_xarray=True)
+    if chunks is not None:
+        dat = dat.chunk(chunks)
     if twophase:
         Phi = dat.gravitational_potential
         add_derived_fields(dat, fields='T', in_place=True)
         dat = dat.where(dat.T < Twarm, other=0)
         dat = dat.drop('T')
         dat['gravitational_potential'] = Phi
-    add_derived_fields(dat, fields=['R','T','surf','Pturb','Pgrav'])
-    dat['surfsfr'] = grid_msp(s,nums[0],0,10/u.Myr)\
-            /(s.domain['dx'][0]*s.domain['dx'][1])/(10/u.Myr)
+    dat['gz_ext'] = gz_ext(s, dat)
+    add_derived_fields(dat, fields=['R','T','surf','Pturb','Pgrav'],
+            in_place=True)
+    dat = dat.drop('gz_ext')
+    with _load_lock:
+        msp = grid_msp(s,num,0,10/u.Myr)
+    dat['surfsfr'] = msp/(s.domain['dx'][0]*s.domain['dx'][1])/(10/u.Myr)
     cos = dat.x/np.sqrt(dat.x**2+dat.y**2)
     sin = dat.y/np.sqrt(dat.x**2+dat.y**2)
     dat['vr'] = dat.velocity1*cos + dat.velocity2*sin
@@ -209,33 +316,39 @@ def sum_dataset(s, nums, twophase=False):
     dat['vz2'] = dat.vz**2
     dat['h'] = 2.5*dat.pressure/dat.density
     dat['cs'] = np.sqrt((5./3.)*dat.pressure/dat.density)
+    if chunks is not None:
+        dat = dat.compute()
+    return dat
+
+def sum_dataset(s, nums, twophase=False, chunks=None, nthreads=1):
+    """Do time-summation on Datasets and return the summed Dataset.
+
+    Parameters
+    ----------
+    s : LoadSimTIGRESSGC instance to be analyzed.
+    nums :list of snapshot numbers to add
+    twophase : include two-phase gas only
+    chunks : if given (e.g. {'z':32}), each snapshot is converted to
+             dask arrays with these chunk sizes, such that the derived
+             fields are evaluated chunk by chunk in parallel. Requires dask.
+    nthreads : number of snapshots that are loaded and derived concurrently.
+               At most nthreads snapshots are held in memory at a time.
+    """
+
+    def load(num):
+        return _load_and_derive(s, num, twophase=twophase, chunks=chunks)
+
+    # load a first vtk and use private copies of its arrays as accumulators
+    dat = load(nums[0]).copy(deep=True)
     # loop through vtks
-    for num in nums[1:]:
-        print(num)
-        ds = s.load_vtk(num=num)
-        tmp = ds.get_field(fields, as_xarray=True)
-        if twophase:
-            Phi = tmp.gravitational_potential
-            add_derived_fields(tmp, fields='T', in_place=True)
-            tmp = tmp.where(tmp.T < Twarm, other=0)
-            tmp = tmp.drop('T')
-            tmp['gravitational_potential'] = Phi
-        add_derived_fields(tmp, fields=['R','T','surf','Pturb','Pgrav'])
-        tmp['surfsfr'] = grid_msp(s,num,0,10/u.Myr)\
-                /(s.domain['dx'][0]*s.domain['dx'][1])/(10/u.Myr)
-        cos = tmp.x/np.sqrt(tmp.x**2+tmp.y**2)
-        sin = tmp.y/np.sqrt(tmp.x**2+tmp.y**2)
-        tmp['vr'] = tmp.velocity1*cos + tmp.velocity2*sin
-        tmp['vp'] = -tmp.velocity1*sin + tmp.velocity2*cos
-        tmp['vz'] = tmp.velocity3
-        tmp = tmp.drop(['velocity1','velocity2','velocity3'])
-        tmp['vr2'] = tmp.vr**2
-        tmp['vp2'] = tmp.vp**2
-        tmp['vz2'] = tmp.vz**2
-        tmp['h'] = 2.5*tmp.pressure/tmp.density
-        tmp['cs'] = np.sqrt((5./3.)*tmp.pressure/tmp.density)
-        # add
-        dat += tmp
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for i in range(1, len(nums), nthreads):
+            batch = nums[i:i+nthreads]
+            for num, tmp in zip(batch, pool.map(load, batch)):
+                print(num)
+                # add in place
+                for k in dat.data_vars:
+                    np.add(dat[k].data, tmp[k].data, out=dat[k].data)
     return dat
 
 def read_stardat(fpath, num):